@@ -0,0 +1,92 @@
+import asyncio
+import math
+from pymongo import errors
+
+class QueryRejected(Exception):
+    """
+    Raised when a query is shed instead of executed; turned into a 429/503 response
+    with a Retry-After header by main.py.
+    """
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class AdmissionController():
+    """
+    Admission control for expensive aggregations:
+    - at most limits[endpoint] queries of an endpoint run at once,
+    - the summed cost estimate of running queries stays under cost_budget,
+    - a query that is over cost_budget on its own runs in a single separate slot that
+      does not use the shared budget, so it cannot block cheaper queries,
+    - identical in-flight queries (same key) share one execution.
+    Admitted queries run in a worker thread so the event loop keeps serving requests.
+    """
+
+    def __init__(self, limits=None, default_limit=4, cost_budget=1000000):
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.cost_budget = cost_budget
+        self.in_flight = {}
+        self.cost_in_flight = 0
+        self.oversized_in_flight = False
+        self.pending = {}
+        # Moving average of query duration per endpoint (seconds), used for Retry-After
+        self.durations = {}
+
+    def retry_after(self, endpoint):
+        return max(1, math.ceil(self.durations.get(endpoint, 1)))
+
+    async def run(self, endpoint, key, cost, fn):
+        """
+        Run fn() (a blocking call) under admission control and return its result.
+        """
+        key = (endpoint, key)
+        task = self.pending.get(key)
+
+        if task is None:
+            if self.in_flight.get(endpoint, 0) >= self.limits.get(endpoint, self.default_limit):
+                raise QueryRejected(429, "Too many concurrent requests for this endpoint.", self.retry_after(endpoint))
+            oversized = cost > self.cost_budget
+            if oversized:
+                if self.oversized_in_flight:
+                    raise QueryRejected(
+                        429,
+                        "Another very expensive query is running. Narrow the date range or retry later.",
+                        self.retry_after(endpoint)
+                    )
+            elif self.cost_in_flight + cost > self.cost_budget:
+                raise QueryRejected(429, "Server is busy with expensive queries.", self.retry_after(endpoint))
+
+            # Account for the query before it is scheduled so concurrent callers see it
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+            if oversized:
+                self.oversized_in_flight = True
+            else:
+                self.cost_in_flight += cost
+            task = asyncio.ensure_future(self.execute(endpoint, key, cost, oversized, fn))
+            self.pending[key] = task
+
+        # Shield so a disconnecting client does not cancel a query others are waiting on
+        try:
+            return await asyncio.shield(task)
+        except errors.ExecutionTimeout:
+            raise QueryRejected(503, "Query exceeded its time limit.", self.retry_after(endpoint))
+
+    async def execute(self, endpoint, key, cost, oversized, fn):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            return await asyncio.to_thread(fn)
+        finally:
+            elapsed = loop.time() - started
+            previous = self.durations.get(endpoint)
+            self.durations[endpoint] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            self.in_flight[endpoint] -= 1
+            if oversized:
+                self.oversized_in_flight = False
+            else:
+                self.cost_in_flight -= cost
+            self.pending.pop(key, None)
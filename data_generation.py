@@ -4,6 +4,7 @@ from faker import Faker
 from geopy.geocoders import Nominatim
 from datetime import datetime, timedelta, date
 from bson import ObjectId
+from geo_utils import encode_geohash
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -67,6 +68,7 @@ def generate_unit_data(city_info, units_per_city=100):
             "unit_id": fake.uuid4(),
             "city_id": city_info["city_name"],
             "location": location,  # GeoJSON field
+            "geohash": encode_geohash(lat, lon),  # Grid cell used by the energy_grid rollup
             "address": address,
             "postal_code": postal_code,  # Extracted from the address
             "unit_type": random.choice(["residential", "industrial", "commercial"])
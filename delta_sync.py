@@ -0,0 +1,77 @@
+import time
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+
+# Version tokens lag the clock so readings still in flight (e.g. in the ingest
+# buffer) when a token is issued are picked up by the next delta request
+SYNC_LAG_SECONDS = 60
+
+VERSION_HEADER = "X-Data-Version"
+
+class InvalidSyncToken(ValueError):
+    pass
+
+def sync_version():
+    """
+    Token for the data a response reflects; clients send it back as `since`.
+    """
+    return str(int(time.time()) - SYNC_LAG_SECONDS)
+
+def parse_since(since):
+    if since is None:
+        return None
+    try:
+        return datetime.fromtimestamp(int(since), tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise InvalidSyncToken(f"Invalid since token: {since!r}")
+
+def bucket_start(value, bucket):
+    day = datetime(value.year, value.month, value.day)
+    if bucket == "week":
+        # Same boundaries as $dateTrunc with unit week (weeks start on Sunday)
+        return day - timedelta(days=(day.weekday() + 1) % 7)
+    if bucket == "month":
+        return datetime(value.year, value.month, 1)
+    return day
+
+def next_bucket(value, bucket):
+    start = bucket_start(value, bucket)
+    if bucket == "week":
+        return start + timedelta(days=7)
+    if bucket == "month":
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+def changed_bucket_range(db, since, device_ids=None, bucket="day", max_time_ms=None):
+    """
+    Return the [start, end) range of day/week/month buckets of the given devices (all
+    devices when device_ids is None) that changed after since, widened to whole buckets
+    so they can be recomputed exactly, or None if nothing changed. A bucket changes when
+    it receives readings (found by the ObjectId time, which the ingest path assigns at
+    write time) or when compaction rewrites one of its daily summaries, e.g. after late
+    readings.
+    """
+    raw_match = { "_id": { "$gte": ObjectId.from_datetime(since) } }
+    daily_match = { "updated_at": { "$gte": since } }
+    if device_ids is not None:
+        raw_match["device_id"] = { "$in": device_ids }
+        daily_match["device_id"] = { "$in": device_ids }
+
+    raw_pipeline = [
+        { "$match": raw_match },
+        { "$group": { "_id": None, "first": { "$min": "$timestamp" }, "last": { "$max": "$timestamp" } } }
+    ]
+    daily_pipeline = [
+        { "$match": daily_match },
+        { "$group": { "_id": None, "first": { "$min": "$date" }, "last": { "$max": "$date" } } }
+    ]
+
+    options = { "maxTimeMS": max_time_ms } if max_time_ms else {}
+    results = list(db["energy_usage"].aggregate(raw_pipeline, **options))
+    results += list(db["energy_usage_daily"].aggregate(daily_pipeline, **options))
+    if not results:
+        return None
+
+    first = min(result["first"] for result in results)
+    last = max(result["last"] for result in results)
+    return bucket_start(first, bucket), next_bucket(last, bucket)
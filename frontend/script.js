@@ -1,5 +1,92 @@
 // script.js
 var url = "http://127.0.0.1:8000";
+
+// Results already fetched per request, so a refresh only asks the backend for new buckets
+var dataStore = {};
+
+function isEmptyDelta(delta) {
+    return Array.isArray(delta) ? delta.length === 0 : Object.keys(delta).length === 0;
+  }
+
+// Fetch a result, or only what changed since the stored version, and merge it into the store
+function fetchWithDelta(key, requestUrl, options, mergeDelta) {
+    const entry = dataStore[key];
+    const deltaUrl = entry
+      ? `${requestUrl}${requestUrl.includes("?") ? "&" : "?"}since=${encodeURIComponent(entry.version)}`
+      : requestUrl;
+
+    return fetch(deltaUrl, options)
+      .then(response => {
+        if (!response.ok) {
+          const error = new Error(`Request failed with status ${response.status}`);
+          // Set on 429/503 responses when the backend sheds load
+          error.retryAfter = response.headers.get("Retry-After");
+          throw error;
+        }
+        const version = response.headers.get("X-Data-Version");
+        return response.json().then(delta => {
+          const changed = !entry || !isEmptyDelta(delta);
+          const data = entry ? mergeDelta(entry.data, delta) : delta;
+          if (version) {
+            dataStore[key] = { version: version, data: data };
+          }
+          return { data: data, changed: changed };
+        });
+      });
+  }
+
+// Handle a failed fetch: never leave the chart of a previous selection on screen,
+// and tell the user when to retry if the backend was too busy
+function handleFetchError(chartContainer, requestKey, error) {
+    if (chartContainer.dataset.key !== requestKey) {
+      chartContainer.innerHTML = "";
+      delete chartContainer.dataset.key;
+    }
+    if (error.retryAfter) {
+      alert(`The server is busy, please try again in ${error.retryAfter} seconds.`);
+    }
+  }
+
+// Tab 1 data is keyed by date, changed dates replace the stored ones
+function mergeDailyAverages(data, delta) {
+    const merged = Object.assign({}, data, delta);
+    const sorted = {};
+    Object.keys(merged).sort().forEach(date => {
+      sorted[date] = merged[date];
+    });
+    return sorted;
+  }
+
+// Tab 3 data is keyed by zip code, changed periods replace the stored ones per zip code
+function mergeZipAverages(data, delta) {
+    const merged = {};
+    new Set([...Object.keys(data), ...Object.keys(delta)]).forEach(zip => {
+      const dates = {};
+      (data[zip] ? data[zip].dates : []).forEach(entry => { dates[entry.date] = entry; });
+      (delta[zip] ? delta[zip].dates : []).forEach(entry => { dates[entry.date] = entry; });
+      const entries = Object.keys(dates).sort().map(date => dates[date]);
+      merged[zip] = {
+        total_average_energy: d3.mean(entries, entry => entry.average_energy),
+        dates: entries
+      };
+    });
+
+    // Keep zip codes ordered by total average energy, like the backend does
+    const ordered = {};
+    Object.keys(merged)
+      .sort((a, b) => merged[b].total_average_energy - merged[a].total_average_energy)
+      .forEach(zip => { ordered[zip] = merged[zip]; });
+    return ordered;
+  }
+
+// Tab 4 data is a list of dates, changed dates replace the stored ones
+function mergeUnitTypeAverages(data, delta) {
+    const byDate = {};
+    data.forEach(d => { byDate[d.date] = d; });
+    delta.forEach(d => { byDate[d.date] = d; });
+    return Object.keys(byDate).sort().map(date => byDate[date]);
+  }
+
 function openTab(evt, tabName) {
     // Declare all variables
     var i, tabcontent, tablinks;
@@ -34,19 +121,24 @@ function fetchDataTab1() {
     const chartContainer = document.getElementById("chart-container-1");
 
     loader.classList.remove("hidden");
-    chartContainer.innerHTML = "";
 
     const city = document.getElementById("city-select-1").value;
     console.log(`Fetching data for city: ${city}`);
     
-    fetch(`${url}/api/daily-average-energy/${encodeURIComponent(city)}`)
-      .then(response => response.json())
-      .then(data => {
+    const requestUrl = `${url}/api/daily-average-energy/${encodeURIComponent(city)}`;
+    fetchWithDelta(requestUrl, requestUrl, {}, mergeDailyAverages)
+      .then(({ data, changed }) => {
         console.log("Data received:", data);
-        renderChartTab1(data);
+        // Only redraw when new buckets arrived (or the chart shows another city)
+        if (changed || chartContainer.dataset.key !== requestUrl) {
+          chartContainer.innerHTML = "";
+          chartContainer.dataset.key = requestUrl;
+          renderChartTab1(data);
+        }
       })
       .catch(error => {
         console.error("Error fetching data:", error);
+        handleFetchError(chartContainer, requestUrl, error);
       })
       .finally(() => {
         // Hide loader after rendering
@@ -277,18 +369,22 @@ function fetchDataTab3() {
     const loader = document.getElementById("loader-3");
     const chartContainer = document.getElementById("chart-container-3");
 
-    // Show loader and hide chart container
+    // Show loader
     loader.classList.remove("hidden");
-    chartContainer.innerHTML = "";    
     
-    fetch(`${url}/api/average-energy-zip/${encodeURIComponent(city)}/${timePeriod}`)
-      .then(response => response.json())
-      .then(data => {
+    const requestUrl = `${url}/api/average-energy-zip/${encodeURIComponent(city)}/${timePeriod}`;
+    fetchWithDelta(requestUrl, requestUrl, {}, mergeZipAverages)
+      .then(({ data, changed }) => {
         console.log("Data received for Tab 3:", data);
-        renderChartTab3(data, timePeriod);
+        if (changed || chartContainer.dataset.key !== requestUrl) {
+          chartContainer.innerHTML = "";
+          chartContainer.dataset.key = requestUrl;
+          renderChartTab3(data, timePeriod);
+        }
       })
       .catch(error => {
         console.error("Error fetching data for Tab 3:", error);
+        handleFetchError(chartContainer, requestUrl, error);
       })
       .finally(() => {
         // Hide loader after rendering
@@ -473,11 +569,11 @@ function fetchDataTab4() {
   const loader = document.getElementById("loader-4");
   const chartContainer = document.getElementById("chart-container-4");
 
-  // Show loader and hide chart container
+  // Show loader
   loader.classList.remove("hidden");
-  chartContainer.innerHTML = "";  
   
-  fetch(`${url}/api/average-daily-usage-by-unit-type`, {
+  const requestKey = `unit-type/${city}/${startDate}/${endDate}`;
+  fetchWithDelta(requestKey, `${url}/api/average-daily-usage-by-unit-type`, {
     method: 'POST',
     headers: {
       'Content-Type': 'application/json'
@@ -487,14 +583,18 @@ function fetchDataTab4() {
       start_date: startDate,
       end_date: endDate
     })
-  })
-    .then(response => response.json())
-    .then(data => {
+  }, mergeUnitTypeAverages)
+    .then(({ data, changed }) => {
       console.log("Data received for Tab 4:", data);
-      renderChartTab4(data);
+      if (changed || chartContainer.dataset.key !== requestKey) {
+        chartContainer.innerHTML = "";
+        chartContainer.dataset.key = requestKey;
+        renderChartTab4(data);
+      }
     })
     .catch(error => {
       console.error("Error fetching data for Tab 4:", error);
+      handleFetchError(chartContainer, requestKey, error);
     })
     .finally(() => {
       // Hide loader after rendering
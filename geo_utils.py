@@ -0,0 +1,57 @@
+# Geohash helpers shared by data generation and the grid rollup in main.py
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Precision of the cells stored in the energy_grid rollup (~1.2km x 0.6km)
+GRID_PRECISION = 6
+
+# Helper function to encode a latitude/longitude pair as a geohash string
+def encode_geohash(lat, lon, precision=GRID_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits, bit_count, even = 0, 0, True
+
+    while len(geohash) < precision:
+        # Even bits refine longitude, odd bits refine latitude
+        value, rng = (lon, lon_range) if even else (lat, lat_range)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = (bits << 1) | 1
+            rng[0] = mid
+        else:
+            bits = bits << 1
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(_BASE32[bits])
+            bits, bit_count = 0, 0
+
+    return "".join(geohash)
+
+# Helper function to decode a geohash into its bounding box and center point
+def decode_geohash(geohash):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in geohash:
+        index = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (index >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+
+    return {
+        "min_lat": lat_range[0],
+        "max_lat": lat_range[1],
+        "min_lon": lon_range[0],
+        "max_lon": lon_range[1],
+        "lat": (lat_range[0] + lat_range[1]) / 2,
+        "lon": (lon_range[0] + lon_range[1]) / 2
+    }
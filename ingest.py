@@ -0,0 +1,203 @@
+import asyncio
+import math
+import time
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import errors
+
+# Same peak window as data_generation (5 PM to 9 PM on weekdays)
+peak_hours = range(17, 21)
+
+class InvalidReading(ValueError):
+    pass
+
+# Helper function to turn an incoming reading into an energy_usage document
+def normalize_reading(raw, oldest=None):
+    if not isinstance(raw, dict):
+        raise InvalidReading("Each reading must be an object.")
+
+    device_id = raw.get("device_id")
+    if not isinstance(device_id, str) or not device_id:
+        raise InvalidReading("Reading is missing 'device_id'.")
+
+    timestamp = raw.get("timestamp")
+    try:
+        if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+            timestamp = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        elif isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+        elif not isinstance(timestamp, datetime):
+            raise InvalidReading("Reading is missing 'timestamp'.")
+    except (ValueError, OverflowError, OSError):
+        raise InvalidReading(f"Invalid timestamp: {raw.get('timestamp')!r}")
+
+    # Stored timestamps are naive UTC, like the generated data
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    if oldest is not None and timestamp < oldest:
+        raise InvalidReading(f"Reading at {timestamp.isoformat()} is older than the raw retention window.")
+
+    energy = raw.get("energy_consumption_kwh")
+    if isinstance(energy, bool) or not isinstance(energy, (int, float)) or not math.isfinite(energy) or energy < 0:
+        raise InvalidReading("Reading needs a non-negative 'energy_consumption_kwh'.")
+
+    peak = raw.get("peak_hours")
+    if not isinstance(peak, bool):
+        peak = timestamp.hour in peak_hours and timestamp.weekday() < 5
+
+    return {
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "energy_consumption_kwh": float(energy),
+        "peak_hours": peak
+    }
+
+class IngestBuffer():
+    """
+    Buffers readings in an asyncio queue and group-commits them to a collection with
+    unordered bulk inserts once batch_size readings are waiting or max_latency_ms has
+    passed since the first reading of the batch arrived.
+    """
+
+    def __init__(self, collection, max_size=100000, batch_size=5000, max_latency_ms=50,
+                 write_retries=3, retry_delay=0.5):
+        self.collection = collection
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.write_retries = write_retries
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.task = None
+        self.stopping = None
+        self.written = 0
+        self.failed = 0
+        # Observed insert throughput (readings/second), used for Retry-After hints
+        self.write_rate = None
+
+    def start(self):
+        if self.task is None:
+            self.stopping = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the writer task once it has flushed everything still buffered,
+        including a batch that was being collected.
+        """
+        if self.task is not None:
+            self.stopping.set()
+            await self.task
+            self.task = None
+
+        # Readings offered while the writer was not running
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await asyncio.to_thread(self.write_batch, batch)
+
+    def offer(self, readings):
+        """
+        Enqueue all readings, or none of them if the buffer does not have room.
+        """
+        if self.max_size - self.queue.qsize() < len(readings):
+            return False
+        for reading in readings:
+            self.queue.put_nowait(reading)
+        return True
+
+    def retry_after(self):
+        """
+        Estimate how many seconds it takes to drain the current backlog.
+        """
+        rate = self.write_rate or (self.batch_size / self.max_latency)
+        return max(1, math.ceil(self.queue.qsize() / rate))
+
+    async def next_reading(self, timeout=None):
+        """
+        Wait for the next buffered reading; None on timeout or once stopping with an empty queue.
+        """
+        if not self.queue.empty():
+            return self.queue.get_nowait()
+        if self.stopping.is_set():
+            return None
+
+        getter = asyncio.ensure_future(self.queue.get())
+        stopper = asyncio.ensure_future(self.stopping.wait())
+        await asyncio.wait({getter, stopper}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        stopper.cancel()
+        if getter.done():
+            return getter.result()
+        # A cancelled Queue.get leaves its reading in the queue
+        getter.cancel()
+        return None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            reading = await self.next_reading()
+            if reading is None:
+                return
+
+            batch = [reading]
+            deadline = loop.time() + self.max_latency
+
+            while len(batch) < self.batch_size:
+                # Take everything already queued without waiting
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                if len(batch) >= self.batch_size:
+                    break
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                reading = await self.next_reading(timeout)
+                if reading is None:
+                    break
+                batch.append(reading)
+
+            # pymongo is blocking, so the write runs in a worker thread
+            await asyncio.to_thread(self.write_batch, batch)
+
+    def write_batch(self, batch):
+        started = time.perf_counter()
+
+        # Ids are assigned at write time, not when the request arrived, so the ObjectId time
+        # used by delta sync and compaction reflects when a reading became visible.
+        # They are kept across retries so a partially applied attempt shows up as duplicates
+        for reading in batch:
+            if "_id" not in reading:
+                reading["_id"] = ObjectId()
+
+        for attempt in range(self.write_retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                break
+            except errors.BulkWriteError as e:
+                # Unordered inserts keep going past bad documents. Duplicate keys come from
+                # documents a failed earlier attempt already inserted, so they count as written
+                write_errors = e.details.get("writeErrors", [])
+                duplicates = sum(1 for error in write_errors if error.get("code") == 11000)
+                self.written += e.details.get("nInserted", 0) + duplicates
+                self.failed += len(write_errors) - duplicates
+                break
+            except errors.ConnectionFailure as e:
+                # Transient (network, failover): retry the whole batch with backoff
+                if attempt == self.write_retries:
+                    self.failed += len(batch)
+                    print(f"Failed to write {len(batch)} readings after {attempt + 1} attempts: {str(e)}")
+                else:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            except errors.PyMongoError as e:
+                self.failed += len(batch)
+                print(f"Failed to write {len(batch)} readings: {str(e)}")
+                break
+
+        elapsed = time.perf_counter() - started
+        if elapsed > 0:
+            rate = len(batch) / elapsed
+            self.write_rate = rate if self.write_rate is None else 0.8 * self.write_rate + 0.2 * rate
@@ -1,9 +1,26 @@
-from fastapi import FastAPI, HTTPException
+import os
+import math
+import json
+import time
+import asyncio
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Literal
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel
-from datetime import datetime
-from pymongo import MongoClient, errors
+from datetime import datetime, timedelta
+from pymongo import MongoClient, errors, ASCENDING, GEOSPHERE, UpdateOne
+from geo_utils import encode_geohash, decode_geohash, GRID_PRECISION
+from ingest import IngestBuffer, InvalidReading, normalize_reading
+from admission import AdmissionController, QueryRejected
+from retention import (create_retention_indexes, energy_data_stages, get_compacted_until, oldest_accepted_day,
+                       run_compaction_schedule)
+from delta_sync import VERSION_HEADER, InvalidSyncToken, changed_bucket_range, parse_since, sync_version
+
+try:
+    import msgpack
+except ImportError:  # MessagePack ingest is optional
+    msgpack = None
 
 # FastAPI app initialization
 app = FastAPI()
@@ -19,6 +36,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all methods
     allow_headers=["*"],  # Allow all headers
+    expose_headers=[VERSION_HEADER, "Retry-After"],  # Headers the frontend needs to read
 )
 
 # MongoDB connection setup
@@ -27,6 +45,261 @@ db = client["iot_energy_usage"]
 units_collection = db["units"]
 devices_collection = db["devices"]
 energy_usage_collection = db["energy_usage"]
+energy_grid_collection = db["energy_grid"]
+
+# Device ingest buffer settings (readings)
+INGEST_BUFFER_SIZE = int(os.environ.get("INGEST_BUFFER_SIZE", 200000))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 5000))
+INGEST_MAX_LATENCY_MS = int(os.environ.get("INGEST_MAX_LATENCY_MS", 50))
+INGEST_MAX_READINGS_PER_REQUEST = 10000
+
+ingest_buffer = None
+
+# Raw hourly readings are kept this many days, older days are served from daily summaries
+RAW_RETENTION_DAYS = int(os.environ.get("RAW_RETENTION_DAYS", 30))
+# Days are compacted once they ended this many hours ago, so late readings still land in raw
+COMPACTION_GRACE_HOURS = int(os.environ.get("COMPACTION_GRACE_HOURS", 6))
+
+compaction_task = None
+# Set once the first compaction run of this worker finished (and the TTL index is in place)
+first_compaction = None
+# Compaction watermark, cached after every run so request handlers do not read it on the
+# event loop. A stale value is safe: days past it are still kept in raw form.
+compaction_watermark = None
+
+# Admission control for analytics queries
+QUERY_MAX_TIME_MS = int(os.environ.get("QUERY_MAX_TIME_MS", 30000))
+# Budget for the summed cost (devices x days) of queries running at once
+QUERY_COST_BUDGET = int(os.environ.get("QUERY_COST_BUDGET", 200000))
+ENDPOINT_CONCURRENCY_LIMITS = {
+    "daily-average-energy": 4,
+    "average-energy-zip": 2,
+    "average-daily-usage-by-unit-type": 4,
+    "top-units": 4,
+    "average-energy-by-device-type": 4,
+    "energy-within-area": 4,
+    "energy-heatmap": 8,
+    "energy-grid-refresh": 1
+}
+
+admission = AdmissionController(ENDPOINT_CONCURRENCY_LIMITS, cost_budget=QUERY_COST_BUDGET)
+
+# Cached inputs of the cost estimate: {key: (expires_at, value)}
+COST_CACHE_SECONDS = 300
+# Keys come from request parameters (city names, areas), so the cache is bounded
+COST_CACHE_MAX_ENTRIES = 1024
+cost_cache = {}
+
+# Equatorial radius of the earth, used to convert distances for $centerSphere
+EARTH_RADIUS_KM = 6378.1
+
+# How often the energy_grid rollup is brought up to date with new readings
+GRID_REFRESH_INTERVAL_SECONDS = int(os.environ.get("GRID_REFRESH_INTERVAL_SECONDS", 900))
+# Readings inserted this long before the previous refresh are rescanned, to cover clock skew
+GRID_REFRESH_OVERLAP_SECONDS = 300
+# Time limit for the background rollup aggregations
+MAINTENANCE_MAX_TIME_MS = int(os.environ.get("MAINTENANCE_MAX_TIME_MS", 30 * 60 * 1000))
+# Token required by the manual refresh endpoint; the endpoint is disabled when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+grid_refresh_task = None
+
+@app.exception_handler(QueryRejected)
+async def query_rejected_handler(request: Request, exc: QueryRejected):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail, "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def cached(key, compute):
+    now = time.monotonic()
+    entry = cost_cache.get(key)
+    if entry is None or entry[0] < now:
+        value = compute()
+        cost_cache.pop(key, None)
+        if len(cost_cache) >= COST_CACHE_MAX_ENTRIES:
+            for expired in [k for k, (expires_at, _) in cost_cache.items() if expires_at < now]:
+                del cost_cache[expired]
+            # Still full: drop the oldest entries (dicts keep insertion order)
+            while len(cost_cache) >= COST_CACHE_MAX_ENTRIES:
+                del cost_cache[next(iter(cost_cache))]
+        entry = (now + COST_CACHE_SECONDS, value)
+        cost_cache[key] = entry
+    return entry[1]
+
+def count_city_devices(city_name):
+    pipeline = [
+        { "$match": { "city_id": city_name } },
+        {
+            "$lookup": {
+                "from": "devices",
+                "localField": "unit_id",
+                "foreignField": "unit_id",
+                "as": "devices"
+            }
+        },
+        { "$group": { "_id": None, "devices": { "$sum": { "$size": "$devices" } } } }
+    ]
+    result = list(units_collection.aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+    return result[0]["devices"] if result else 0
+
+def data_span_days():
+    """
+    Number of days covered by the stored readings (daily summaries and raw readings).
+    """
+    first_daily = db["energy_usage_daily"].find_one({}, { "date": 1 }, sort=[("date", ASCENDING)], max_time_ms=QUERY_MAX_TIME_MS)
+    first_raw = energy_usage_collection.find_one({}, { "timestamp": 1 }, sort=[("timestamp", ASCENDING)], max_time_ms=QUERY_MAX_TIME_MS)
+    last_raw = energy_usage_collection.find_one({}, { "timestamp": 1 }, sort=[("timestamp", -1)], max_time_ms=QUERY_MAX_TIME_MS)
+
+    first = first_daily["date"] if first_daily else first_raw["timestamp"] if first_raw else None
+    last = last_raw["timestamp"] if last_raw else None
+    if first is None or last is None:
+        return 1
+    return max(1, (last - first).days + 1)
+
+def query_cost(city_name=None, start=None, end=None, devices=None):
+    """
+    Estimate the cost of an analytics query as devices x days in the requested range.
+    """
+    if devices is None:
+        devices = cached(("devices", city_name), lambda: count_city_devices(city_name))
+    if start and end:
+        days = max(1, (end - start).days)
+    else:
+        days = cached("span", data_span_days)
+    return devices * days
+
+def area_query_cost(area_key, geometry_filter, start=None, end=None):
+    """
+    Estimate the cost of an area query from the number of units inside the area.
+    area_key identifies the area (the serialized filter) for caching.
+    """
+    units = cached(
+        ("area_units", area_key),
+        lambda: units_collection.count_documents({ "location": { "$geoWithin": geometry_filter } }, maxTimeMS=QUERY_MAX_TIME_MS)
+    )
+    devices_per_unit = cached(
+        "devices_per_unit",
+        lambda: devices_collection.estimated_document_count() / max(1, units_collection.estimated_document_count())
+    )
+    return query_cost(start=start, end=end, devices=math.ceil(units * devices_per_unit))
+
+async def estimate_query_cost(endpoint, key, estimate, *args):
+    """
+    Run a blocking cost estimate under admission control as "<endpoint>-estimate": identical
+    estimates (same key as the query) share one run, their concurrency is limited, and an
+    estimate that times out sheds the query with a 503.
+    """
+    return await admission.run(f"{endpoint}-estimate", key, 0, lambda: estimate(*args))
+
+def city_device_ids(city_name):
+    pipeline = [
+        { "$match": { "city_id": city_name } },
+        {
+            "$lookup": {
+                "from": "devices",
+                "localField": "unit_id",
+                "foreignField": "unit_id",
+                "as": "devices"
+            }
+        },
+        { "$unwind": "$devices" },
+        { "$group": { "_id": None, "device_ids": { "$addToSet": "$devices.device_id" } } }
+    ]
+    result = list(units_collection.aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+    return result[0]["device_ids"] if result else []
+
+def city_changed_bucket_range(city_name, since, bucket):
+    device_ids = cached(("device_ids", city_name), lambda: city_device_ids(city_name))
+    if not device_ids:
+        return None
+    return changed_bucket_range(db, since, device_ids, bucket, QUERY_MAX_TIME_MS)
+
+async def resolve_sync_range(since, city_name, bucket="day"):
+    """
+    Translate a since token into the range of the city's buckets that have to be recomputed.
+    Returns (None, None) for a full fetch and None when nothing changed since the token.
+    """
+    try:
+        since = parse_since(since)
+    except InvalidSyncToken as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if since is None:
+        return None, None
+    try:
+        return await asyncio.to_thread(city_changed_bucket_range, city_name, since, bucket)
+    except errors.ExecutionTimeout:
+        raise QueryRejected(503, "Finding changed data exceeded its time limit.", 1)
+
+@app.on_event("startup")
+def create_indexes():
+    """
+    Create the indexes needed by the geospatial endpoints and the energy_grid rollup.
+    """
+    units_collection.create_index([("location", GEOSPHERE)])
+    units_collection.create_index([("geohash", ASCENDING)])
+    energy_grid_collection.create_index([("city_id", ASCENDING), ("date", ASCENDING)])
+    energy_grid_collection.create_index([("geohash", ASCENDING), ("date", ASCENDING)])
+
+@app.on_event("startup")
+async def start_ingest_buffer():
+    """
+    Start the background task that group-commits ingested readings.
+    """
+    global ingest_buffer
+    ingest_buffer = IngestBuffer(
+        energy_usage_collection,
+        max_size=INGEST_BUFFER_SIZE,
+        batch_size=INGEST_BATCH_SIZE,
+        max_latency_ms=INGEST_MAX_LATENCY_MS
+    )
+    ingest_buffer.start()
+
+@app.on_event("startup")
+async def start_compaction_job():
+    """
+    Start the scheduled job that compacts old hourly readings into daily summaries.
+    """
+    global compaction_task, first_compaction, compaction_watermark
+    # Fail startup on bad settings instead of inside the background task
+    if RAW_RETENTION_DAYS < 3:
+        raise ValueError("RAW_RETENTION_DAYS must be at least 3 so late readings can be compacted before they expire.")
+    if not 0 <= COMPACTION_GRACE_HOURS < (RAW_RETENTION_DAYS - 1) * 24:
+        raise ValueError("COMPACTION_GRACE_HOURS must be non-negative and shorter than the retention window minus a day.")
+
+    create_retention_indexes(db)
+    compaction_watermark = get_compacted_until(db, QUERY_MAX_TIME_MS)
+    first_compaction = asyncio.Event()
+    compaction_task = asyncio.create_task(run_compaction_schedule(
+        db, RAW_RETENTION_DAYS, COMPACTION_GRACE_HOURS, on_compacted=compaction_finished
+    ))
+
+def compaction_finished(compacted_until):
+    global compaction_watermark
+    compaction_watermark = compacted_until
+    first_compaction.set()
+
+@app.on_event("startup")
+async def start_energy_grid_job():
+    """
+    Start the scheduled job that keeps the energy_grid rollup current.
+    """
+    global grid_refresh_task
+    grid_refresh_task = asyncio.create_task(run_energy_grid_schedule())
+
+@app.on_event("shutdown")
+async def stop_ingest_buffer():
+    """
+    Flush readings that are still buffered before the worker exits.
+    """
+    if ingest_buffer is not None:
+        await ingest_buffer.stop()
+    if compaction_task is not None:
+        compaction_task.cancel()
+    if grid_refresh_task is not None:
+        grid_refresh_task.cancel()
 
 # Request model
 class EnergyUsageRequest(BaseModel):
@@ -34,12 +307,26 @@ class EnergyUsageRequest(BaseModel):
     start_date: str  # Format: "YYYY-MM-DD"
     end_date: str = None 
 
+class PolygonRequest(BaseModel):
+    coordinates: List[List[float]]  # Closed ring of [longitude, latitude] pairs
+    start_date: Optional[str] = None  # Format: "YYYY-MM-DD"
+    end_date: Optional[str] = None
+
 @app.get("/api/daily-average-energy/{city_name}", response_model=Dict[str, Dict[str, float]])
-async def get_daily_average_energy_by_city(city_name: str):
+async def get_daily_average_energy_by_city(city_name: str, http_response: Response, since: Optional[str] = None):
     """
     Optimized Endpoint to get the daily average energy consumption during peak and off-peak hours
     for a specific city.
+    With a since token only the dates that received readings after it are returned.
     """
+    version = sync_version()
+    http_response.headers[VERSION_HEADER] = version
+
+    sync_range = await resolve_sync_range(since, city_name)
+    if sync_range is None:
+        return {}
+    start, end = sync_range
+
     try:
         pipeline = [
             {
@@ -56,19 +343,12 @@ async def get_daily_average_energy_by_city(city_name: str):
                 }
             },
             { "$unwind": "$devices" },
-            {
-                "$lookup": {
-                    "from": "energy_usage",
-                    "localField": "devices.device_id",
-                    "foreignField": "device_id",
-                    "as": "energy_data"
-                }
-            },
-            { "$unwind": "$energy_data" },
+            *energy_data_stages(compaction_watermark, "devices.device_id", start, end),
             {
                 "$project": {
                     "city": "$city_id",
                     "energy_consumption_kwh": "$energy_data.energy_consumption_kwh",
+                    "count": "$energy_data.count",
                     "date": {
                         "$dateToString": { "format": "%Y-%m-%d", "date": "$energy_data.timestamp" }
                     },
@@ -79,7 +359,7 @@ async def get_daily_average_energy_by_city(city_name: str):
                 "$group": {
                     "_id": { "city": "$city", "date": "$date", "peak_hours": "$peak_hours" },
                     "total_energy_consumption": { "$sum": "$energy_consumption_kwh" },
-                    "count": { "$sum": 1 }
+                    "count": { "$sum": "$count" }
                 }
             },
             {
@@ -93,9 +373,15 @@ async def get_daily_average_energy_by_city(city_name: str):
             { "$sort": { "date": 1, "peak_hours": -1 } }
         ]
         
-        result = list(units_collection.aggregate(pipeline))
+        key = (city_name, start, end)
+        result = await admission.run(
+            "daily-average-energy",
+            key,
+            await estimate_query_cost("daily-average-energy", key, query_cost, city_name, start, end),
+            lambda: list(units_collection.aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
         
-        if not result:
+        if not result and since is None:
             raise HTTPException(status_code=404, detail="City not found or no data available")
         
         response = {}
@@ -113,6 +399,8 @@ async def get_daily_average_energy_by_city(city_name: str):
 
         return response
 
+    except (HTTPException, QueryRejected):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -161,14 +449,26 @@ async def get_cluster_health():
 @app.get("/api/average-energy-zip/{city_name}/{time_period}")
 async def get_average_energy_by_zip(
     city_name: str,
-    time_period: Literal["day", "week", "month"]
+    time_period: Literal["day", "week", "month"],
+    http_response: Response,
+    since: Optional[str] = None
 ):
     """
     Optimized Endpoint to calculate the average energy consumption per ZIP code for a specific city.
     Grouping is based on the specified time period: day, week, or month.
     ZIP codes are sorted by total average energy usage in descending order, and dates within each ZIP code
     are sorted in chronological order.
+    With a since token only the periods that received readings after it are returned, and
+    total_average_energy only covers those periods.
     """
+    version = sync_version()
+    http_response.headers[VERSION_HEADER] = version
+
+    sync_range = await resolve_sync_range(since, city_name, time_period)
+    if sync_range is None:
+        return {}
+    start, end = sync_range
+
     try:
         pipeline = [
             {
@@ -185,20 +485,13 @@ async def get_average_energy_by_zip(
                 }
             },
             { "$unwind": "$devices" },
-            {
-                "$lookup": {
-                    "from": "energy_usage",
-                    "localField": "devices.device_id",
-                    "foreignField": "device_id",
-                    "as": "energy_data"
-                }
-            },
-            { "$unwind": "$energy_data" },
+            *energy_data_stages(compaction_watermark, "devices.device_id", start, end),
             {
                 "$addFields": {
                     "postal_code": "$postal_code",
                     "timestamp": "$energy_data.timestamp",
-                    "energy_consumption_kwh": "$energy_data.energy_consumption_kwh"
+                    "energy_consumption_kwh": "$energy_data.energy_consumption_kwh",
+                    "count": "$energy_data.count"
                 }
             },
             {
@@ -222,7 +515,7 @@ async def get_average_energy_by_zip(
                     "$group": {
                         "_id": { "zip_code": "$postal_code", "date": "$group_date" },
                         "total_energy": { "$sum": "$energy_consumption_kwh" },
-                        "count": { "$sum": 1 }
+                        "count": { "$sum": "$count" }
                     }
                 },
                 {
@@ -250,7 +543,7 @@ async def get_average_energy_by_zip(
                     "$group": {
                         "_id": { "zip_code": "$postal_code", "week_start": "$week_start" },
                         "total_energy": { "$sum": "$energy_consumption_kwh" },
-                        "count": { "$sum": 1 }
+                        "count": { "$sum": "$count" }
                     }
                 },
                 {
@@ -277,7 +570,7 @@ async def get_average_energy_by_zip(
                     "$group": {
                         "_id": { "zip_code": "$postal_code", "date": "$group_date" },
                         "total_energy": { "$sum": "$energy_consumption_kwh" },
-                        "count": { "$sum": 1 }
+                        "count": { "$sum": "$count" }
                     }
                 },
                 {
@@ -316,9 +609,15 @@ async def get_average_energy_by_zip(
             }
         ]
 
-        result = list(db["units"].aggregate(pipeline))
+        key = (city_name, time_period, start, end)
+        result = await admission.run(
+            "average-energy-zip",
+            key,
+            await estimate_query_cost("average-energy-zip", key, query_cost, city_name, start, end),
+            lambda: list(db["units"].aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
         
-        if not result:
+        if not result and since is None:
             raise HTTPException(status_code=404, detail="No data found for the specified city or time period.")
 
         response = {}
@@ -331,11 +630,17 @@ async def get_average_energy_by_zip(
 
         return response
 
+    except (HTTPException, QueryRejected):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error calculating average energy: {str(e)}")
     
 @app.post("/api/average-daily-usage-by-unit-type")
-async def average_daily_usage_by_unit_type(request: EnergyUsageRequest):
+async def average_daily_usage_by_unit_type(request: EnergyUsageRequest, http_response: Response, since: Optional[str] = None):
+    """
+    Endpoint to get the average daily usage per unit type for a city between two dates.
+    With a since token only the dates that received readings after it are returned.
+    """
     try:
         start_date = datetime.strptime(request.start_date, "%Y-%m-%d")
         end_date = (
@@ -349,6 +654,19 @@ async def average_daily_usage_by_unit_type(request: EnergyUsageRequest):
     if end_date < start_date:
         raise HTTPException(status_code=400, detail="End date cannot be earlier than start date.")
 
+    version = sync_version()
+    http_response.headers[VERSION_HEADER] = version
+
+    # The end date is inclusive, so readings are taken up to the start of the next day
+    start, end = start_date, end_date + timedelta(days=1)
+    sync_range = await resolve_sync_range(since, request.city_name)
+    if sync_range is None:
+        return []
+    if sync_range[0] is not None:
+        start, end = max(start, sync_range[0]), min(end, sync_range[1])
+        if start >= end:
+            return []
+
     pipeline = [
         {
             "$match": {
@@ -364,23 +682,7 @@ async def average_daily_usage_by_unit_type(request: EnergyUsageRequest):
             }
         },
         {"$unwind": "$devices"},
-        {
-            "$lookup": {
-                "from": "energy_usage",
-                "localField": "devices.device_id",
-                "foreignField": "device_id",
-                "as": "energy_data"
-            }
-        },
-        {"$unwind": "$energy_data"},
-        {
-            "$match": {
-                "energy_data.timestamp": {
-                    "$gte": start_date,
-                    "$lte": end_date
-                }
-            }
-        },
+        *energy_data_stages(compaction_watermark, "devices.device_id", start, end),
         {
             "$group": {
                 "_id": {
@@ -392,7 +694,13 @@ async def average_daily_usage_by_unit_type(request: EnergyUsageRequest):
                     },
                     "unit_type": "$unit_type"
                 },
-                "average_daily_usage": {"$avg": "$energy_data.energy_consumption_kwh"}
+                "total_usage": {"$sum": "$energy_data.energy_consumption_kwh"},
+                "count": {"$sum": "$energy_data.count"}
+            }
+        },
+        {
+            "$addFields": {
+                "average_daily_usage": {"$divide": ["$total_usage", "$count"]}
             }
         },
         {
@@ -419,10 +727,18 @@ async def average_daily_usage_by_unit_type(request: EnergyUsageRequest):
     ]
 
     try:
-        results = list(db["units"].aggregate(pipeline))
-        if not results:
+        key = (request.city_name, start, end)
+        results = await admission.run(
+            "average-daily-usage-by-unit-type",
+            key,
+            await estimate_query_cost("average-daily-usage-by-unit-type", key, query_cost, request.city_name, start, end),
+            lambda: list(db["units"].aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
+        if not results and since is None:
             raise HTTPException(status_code=404, detail="No data found for the provided inputs.")
         return results
+    except (HTTPException, QueryRejected):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
@@ -441,15 +757,7 @@ async def get_top_units(city_name: str):
             }
         },
         { "$unwind": "$devices" },
-        {
-            "$lookup": {
-                "from": "energy_usage",
-                "localField": "devices.device_id",
-                "foreignField": "device_id",
-                "as": "energy_data"
-            }
-        },
-        { "$unwind": "$energy_data" },
+        *energy_data_stages(compaction_watermark, "devices.device_id"),
         {
             "$group": {
                 "_id": "$unit_id",
@@ -470,12 +778,19 @@ async def get_top_units(city_name: str):
     ]
 
     try:
-        results = list(db["units"].aggregate(pipeline))
+        results = await admission.run(
+            "top-units",
+            city_name,
+            await estimate_query_cost("top-units", city_name, query_cost, city_name),
+            lambda: list(db["units"].aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
 
         if not results:
             raise HTTPException(status_code=404, detail="No data found for the given city.")
 
         return results
+    except (HTTPException, QueryRejected):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
@@ -494,38 +809,459 @@ async def get_average_energy_by_device_type(city_name: str):
         {
             "$match": { "unit_info.city_id": city_name }
         },
-        {
-            "$lookup": {
-                "from": "energy_usage",
-                "localField": "device_id",
-                "foreignField": "device_id",
-                "as": "energy_data"
-            }
-        },
-        { "$unwind": "$energy_data" },
+        *energy_data_stages(compaction_watermark, "device_id"),
         {
             "$group": {
                 "_id": "$type", 
-                "average_energy_usage": { "$avg": "$energy_data.energy_consumption_kwh" }
+                "total_energy_usage": { "$sum": "$energy_data.energy_consumption_kwh" },
+                "count": { "$sum": "$energy_data.count" }
             }
         },
         {
             "$project": {
                 "_id": 0,
                 "device_type": "$_id",
-                "average_energy_usage": 1
+                "average_energy_usage": { "$divide": ["$total_energy_usage", "$count"] }
             }
         }
     ]
 
     try:
-        results = list(db["devices"].aggregate(pipeline))
+        results = await admission.run(
+            "average-energy-by-device-type",
+            city_name,
+            await estimate_query_cost("average-energy-by-device-type", city_name, query_cost, city_name),
+            lambda: list(db["devices"].aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
 
         if not results:
             raise HTTPException(status_code=404, detail="No data found for the given city.")
 
         return results
+    except (HTTPException, QueryRejected):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    
 
+def parse_date_range(start_date, end_date):
+    """
+    Parse optional "YYYY-MM-DD" bounds into datetimes. The end date is inclusive,
+    so the returned upper bound is the start of the following day.
+    """
+    try:
+        start = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
+        end = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use 'YYYY-MM-DD'.")
+
+    if start and end and end <= start:
+        raise HTTPException(status_code=400, detail="End date cannot be earlier than start date.")
+
+    return start, end
+
+async def energy_within_area(geometry_filter, start_date=None, end_date=None):
+    """
+    Aggregate the energy usage of all units whose location matches the given $geoWithin filter.
+    The $geoWithin match is served by the 2dsphere index on units.location.
+    """
+    start, end = parse_date_range(start_date, end_date)
+
+    pipeline = [
+        {
+            "$match": {
+                "location": { "$geoWithin": geometry_filter }
+            }
+        },
+        {
+            "$lookup": {
+                "from": "devices",
+                "localField": "unit_id",
+                "foreignField": "unit_id",
+                "as": "devices"
+            }
+        },
+        { "$unwind": "$devices" },
+        *energy_data_stages(compaction_watermark, "devices.device_id", start, end),
+        {
+            "$group": {
+                "_id": None,
+                "units": { "$addToSet": "$unit_id" },
+                "devices": { "$addToSet": "$devices.device_id" },
+                "reading_count": { "$sum": "$energy_data.count" },
+                "total_energy": { "$sum": "$energy_data.energy_consumption_kwh" },
+                "on_peak_energy": {
+                    "$sum": { "$cond": ["$energy_data.peak_hours", "$energy_data.energy_consumption_kwh", 0] }
+                }
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "unit_count": { "$size": "$units" },
+                "device_count": { "$size": "$devices" },
+                "reading_count": 1,
+                "total_energy": 1,
+                "on_peak_energy": 1,
+                "off_peak_energy": { "$subtract": ["$total_energy", "$on_peak_energy"] },
+                "average_energy": { "$divide": ["$total_energy", "$reading_count"] }
+            }
+        }
+    ]
+
+    try:
+        area_key = json.dumps(geometry_filter, sort_keys=True)
+        results = await admission.run(
+            "energy-within-area",
+            (area_key, start, end),
+            await estimate_query_cost("energy-within-area", (area_key, start, end), area_query_cost, area_key, geometry_filter, start, end),
+            lambda: list(units_collection.aggregate(pipeline, allowDiskUse=True, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
+    except QueryRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    if not results:
+        raise HTTPException(status_code=404, detail="No units or energy data found in the given area.")
+
+    return results[0]
+
+@app.get("/api/energy-within-radius")
+async def get_energy_within_radius(
+    lon: float,
+    lat: float,
+    radius_km: float,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """
+    Endpoint to get the energy consumption of all units within radius_km of a point.
+    """
+    if radius_km <= 0:
+        raise HTTPException(status_code=400, detail="radius_km must be greater than 0.")
+
+    geometry_filter = { "$centerSphere": [[lon, lat], radius_km / EARTH_RADIUS_KM] }
+    return await energy_within_area(geometry_filter, start_date, end_date)
+
+@app.get("/api/energy-within-box")
+async def get_energy_within_box(
+    min_lon: float,
+    min_lat: float,
+    max_lon: float,
+    max_lat: float,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """
+    Endpoint to get the energy consumption of all units inside a bounding box.
+    """
+    if min_lon >= max_lon or min_lat >= max_lat:
+        raise HTTPException(status_code=400, detail="Bounding box minimums must be less than maximums.")
+
+    # $box is planar and cannot use the 2dsphere index, so the box is expressed as a GeoJSON polygon
+    geometry_filter = {
+        "$geometry": {
+            "type": "Polygon",
+            "coordinates": [[
+                [min_lon, min_lat],
+                [max_lon, min_lat],
+                [max_lon, max_lat],
+                [min_lon, max_lat],
+                [min_lon, min_lat]
+            ]]
+        }
+    }
+    return await energy_within_area(geometry_filter, start_date, end_date)
+
+@app.post("/api/energy-within-polygon")
+async def get_energy_within_polygon(request: PolygonRequest):
+    """
+    Endpoint to get the energy consumption of all units inside a GeoJSON polygon ring.
+    """
+    ring = request.coordinates
+    if not ring or any(len(point) != 2 for point in ring):
+        raise HTTPException(status_code=400, detail="Polygon points must be [longitude, latitude] pairs.")
+
+    # GeoJSON rings must be closed
+    if ring[0] != ring[-1]:
+        ring = ring + [ring[0]]
+
+    # A closed ring needs at least 4 positions made of 3 distinct points
+    if len(ring) < 4 or len({tuple(point) for point in ring}) < 3:
+        raise HTTPException(status_code=400, detail="Polygon needs at least 3 distinct [longitude, latitude] points.")
+
+    geometry_filter = { "$geometry": { "type": "Polygon", "coordinates": [ring] } }
+    return await energy_within_area(geometry_filter, request.start_date, request.end_date)
+
+def backfill_unit_geohashes():
+    """
+    Assign a geohash cell to units that were inserted before the field existed.
+    """
+    updates = []
+    for unit in units_collection.find({ "geohash": { "$exists": False }, "location": { "$exists": True } }, { "location": 1 }):
+        lon, lat = unit["location"]["coordinates"]
+        updates.append(UpdateOne({ "_id": unit["_id"] }, { "$set": { "geohash": encode_geohash(lat, lon) } }))
+
+    if updates:
+        units_collection.bulk_write(updates, ordered=False)
+    return len(updates)
+
+def refresh_energy_grid(since=None):
+    """
+    Rebuild the energy_grid rollup (one document per geohash cell per day) from the raw readings.
+    When since is given only days on or after it are recomputed; whole days are always
+    recomputed so the merged cells stay exact.
+    """
+    backfill_unit_geohashes()
+
+    if since:
+        since = datetime(since.year, since.month, since.day)
+
+    pipeline = [
+        {
+            "$match": { "geohash": { "$exists": True } }
+        },
+        {
+            "$lookup": {
+                "from": "devices",
+                "localField": "unit_id",
+                "foreignField": "unit_id",
+                "as": "devices"
+            }
+        },
+        { "$unwind": "$devices" },
+        *energy_data_stages(get_compacted_until(db, MAINTENANCE_MAX_TIME_MS), "devices.device_id", since),
+        {
+            "$group": {
+                "_id": {
+                    "geohash": "$geohash",
+                    "date": { "$dateToString": { "format": "%Y-%m-%d", "date": "$energy_data.timestamp" } }
+                },
+                "city_id": { "$first": "$city_id" },
+                "total_energy": { "$sum": "$energy_data.energy_consumption_kwh" },
+                "on_peak_energy": {
+                    "$sum": { "$cond": ["$energy_data.peak_hours", "$energy_data.energy_consumption_kwh", 0] }
+                },
+                "count": { "$sum": "$energy_data.count" }
+            }
+        },
+        {
+            "$project": {
+                "geohash": "$_id.geohash",
+                "date": "$_id.date",
+                "city_id": 1,
+                "total_energy": 1,
+                "on_peak_energy": 1,
+                "count": 1,
+                "updated_at": "$$NOW"
+            }
+        },
+        {
+            "$merge": {
+                "into": "energy_grid",
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+    units_collection.aggregate(pipeline, allowDiskUse=True, maxTimeMS=MAINTENANCE_MAX_TIME_MS)
+
+def refresh_energy_grid_incremental():
+    """
+    Bring the energy_grid rollup up to date: recompute the days that changed since the
+    previous refresh, or everything on the first run. A day changes when it receives raw
+    readings or when compaction re-summarizes it (e.g. after late readings), since days
+    before the compaction watermark are read from the daily summaries.
+    """
+    started = datetime.utcnow()
+    state = db["rollup_state"].find_one({ "_id": "energy_grid" }, max_time_ms=MAINTENANCE_MAX_TIME_MS)
+
+    if state is None:
+        refresh_energy_grid()
+    else:
+        scan_from = state["refreshed_at"] - timedelta(seconds=GRID_REFRESH_OVERLAP_SECONDS)
+        changed = changed_bucket_range(db, scan_from, max_time_ms=MAINTENANCE_MAX_TIME_MS)
+        if changed:
+            refresh_energy_grid(changed[0])
+
+    db["rollup_state"].update_one(
+        { "_id": "energy_grid" },
+        { "$set": { "refreshed_at": started } },
+        upsert=True
+    )
+
+async def run_energy_grid_schedule(interval=GRID_REFRESH_INTERVAL_SECONDS):
+    """
+    Background job that keeps the energy_grid rollup current. It starts after the first
+    compaction run: the TTL index may expire old raw readings while a build is reading
+    them, and only once days are compacted are those read from the daily summaries.
+    """
+    await first_compaction.wait()
+    while True:
+        try:
+            await asyncio.to_thread(refresh_energy_grid_incremental)
+        except errors.PyMongoError as e:
+            print(f"Energy grid refresh failed: {str(e)}")
+        await asyncio.sleep(interval)
+
+@app.post("/api/energy-grid/refresh")
+async def refresh_energy_grid_endpoint(request: Request, since: Optional[str] = None):
+    """
+    Endpoint to force a rebuild of the geohash grid rollup used by the heatmap endpoint.
+    Pass since=YYYY-MM-DD to only recompute recent days. Requires the X-Admin-Token header.
+    """
+    if ADMIN_TOKEN is None or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Refreshing the energy grid requires a valid admin token.")
+
+    since_date, _ = parse_date_range(since, None)
+
+    if first_compaction is None or not first_compaction.is_set():
+        raise QueryRejected(503, "Waiting for the first compaction run before the grid can be rebuilt.", 60)
+
+    try:
+        # Concurrent refreshes share one run, and the rebuild runs off the event loop
+        await admission.run("energy-grid-refresh", since_date, 0, lambda: refresh_energy_grid(since_date))
+        cells = await asyncio.to_thread(energy_grid_collection.estimated_document_count)
+        return { "cells": cells }
+    except QueryRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+@app.get("/api/energy-heatmap/{city_name}")
+async def get_energy_heatmap(
+    city_name: str,
+    precision: int = GRID_PRECISION,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+):
+    """
+    Endpoint to get per-cell energy consumption for a city from the pre-aggregated energy_grid.
+    Coarser cells are obtained by truncating the stored geohash to the requested precision,
+    so no raw readings are read.
+    """
+    if precision < 1 or precision > GRID_PRECISION:
+        raise HTTPException(status_code=400, detail=f"precision must be between 1 and {GRID_PRECISION}.")
+
+    start, end = parse_date_range(start_date, end_date)
+
+    match = { "city_id": city_name }
+    date_filter = {}
+    if start:
+        date_filter["$gte"] = start.strftime("%Y-%m-%d")
+    if end:
+        date_filter["$lt"] = end.strftime("%Y-%m-%d")
+    if date_filter:
+        match["date"] = date_filter
+
+    pipeline = [
+        { "$match": match },
+        {
+            "$group": {
+                "_id": { "$substrCP": ["$geohash", 0, precision] },
+                "total_energy": { "$sum": "$total_energy" },
+                "on_peak_energy": { "$sum": "$on_peak_energy" },
+                "count": { "$sum": "$count" }
+            }
+        },
+        { "$sort": { "total_energy": -1 } }
+    ]
+
+    try:
+        # Grid cells are already aggregated, so the query cost does not depend on the readings
+        results = await admission.run(
+            "energy-heatmap",
+            (city_name, precision, start, end),
+            0,
+            lambda: list(energy_grid_collection.aggregate(pipeline, maxTimeMS=QUERY_MAX_TIME_MS))
+        )
+    except QueryRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+    if not results:
+        raise HTTPException(status_code=404, detail="No grid data found for the given city. Refresh the energy grid first.")
+
+    cells = []
+    for item in results:
+        bounds = decode_geohash(item["_id"])
+        cells.append({
+            "geohash": item["_id"],
+            "lat": bounds["lat"],
+            "lon": bounds["lon"],
+            "bounds": [[bounds["min_lon"], bounds["min_lat"]], [bounds["max_lon"], bounds["max_lat"]]],
+            "total_energy": item["total_energy"],
+            "on_peak_energy": item["on_peak_energy"],
+            "off_peak_energy": item["total_energy"] - item["on_peak_energy"],
+            "average_energy": item["total_energy"] / item["count"]
+        })
+
+    return cells
+
+@app.post("/api/ingest", status_code=202)
+async def ingest_readings(request: Request):
+    """
+    Endpoint for devices to push batches of readings, either as JSON or MessagePack
+    (Content-Type: application/msgpack). The body is a list of readings or {"readings": [...]}.
+    Readings are buffered and written in the background; when the buffer is full the
+    whole batch is rejected with 429 and a Retry-After hint.
+    """
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip()
+    body = await request.body()
+
+    try:
+        if content_type in ("application/msgpack", "application/x-msgpack"):
+            if msgpack is None:
+                raise HTTPException(status_code=415, detail="MessagePack support is not installed on this server.")
+            payload = msgpack.unpackb(body, raw=False, timestamp=3)
+        elif content_type == "application/json":
+            payload = json.loads(body)
+        else:
+            raise HTTPException(status_code=415, detail="Use application/json or application/msgpack.")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode request body: {str(e)}")
+
+    if isinstance(payload, dict):
+        payload = payload.get("readings")
+    if not isinstance(payload, list) or not payload:
+        raise HTTPException(status_code=400, detail="Expected a non-empty list of readings.")
+    if len(payload) > INGEST_MAX_READINGS_PER_REQUEST:
+        raise HTTPException(status_code=413, detail=f"At most {INGEST_MAX_READINGS_PER_REQUEST} readings per request.")
+
+    # Older readings could land in a day whose raw readings expire before compaction re-summarizes it
+    oldest = oldest_accepted_day(datetime.utcnow(), RAW_RETENTION_DAYS)
+    try:
+        readings = [normalize_reading(raw, oldest) for raw in payload]
+    except InvalidReading as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if ingest_buffer is None or not ingest_buffer.offer(readings):
+        retry_after = ingest_buffer.retry_after() if ingest_buffer is not None else 1
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Ingest buffer is full, retry later.", "retry_after": retry_after},
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    return {"accepted": len(readings), "buffered": ingest_buffer.queue.qsize()}
+
+@app.get("/api/ingest/stats")
+async def get_ingest_stats():
+    """
+    Report the state of the ingest buffer for this worker.
+    """
+    if ingest_buffer is None:
+        raise HTTPException(status_code=503, detail="Ingest buffer is not running.")
+
+    return {
+        "buffered": ingest_buffer.queue.qsize(),
+        "capacity": ingest_buffer.max_size,
+        "written": ingest_buffer.written,
+        "failed": ingest_buffer.failed,
+        "write_rate": ingest_buffer.write_rate
+    }
@@ -0,0 +1,276 @@
+import asyncio
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING, errors
+
+# How often the scheduled job compacts finished days into energy_usage_daily
+COMPACTION_INTERVAL_SECONDS = 3600
+
+# Readings inserted this long before the previous run are rescanned for late days, to cover clock skew
+LATE_SCAN_OVERLAP_SECONDS = 300
+
+DAILY_COLLECTION = "energy_usage_daily"
+STATE_COLLECTION = "retention_state"
+TTL_INDEX_NAME = "timestamp_ttl"
+
+def start_of_day(value):
+    return datetime(value.year, value.month, value.day)
+
+def oldest_accepted_day(now, retention_days, interval=COMPACTION_INTERVAL_SECONDS):
+    """
+    First day that may still receive readings. A late reading makes compaction re-summarize
+    its whole day from the raw readings, so every raw reading of that day has to outlive the
+    next compaction run by at least a full day.
+    """
+    return start_of_day(now + timedelta(seconds=interval)) - timedelta(days=retention_days - 2)
+
+def get_compacted_until(db, max_time_ms=None):
+    """
+    Return the first day that has not been compacted yet. Every day before it is
+    fully summarized in energy_usage_daily; None means nothing has been compacted.
+    """
+    state = db[STATE_COLLECTION].find_one({ "_id": DAILY_COLLECTION }, max_time_ms=max_time_ms)
+    return state["compacted_until"] if state else None
+
+def summarize_days(db, reading_filter):
+    """
+    Summarize the raw readings matching reading_filter into one document per device per
+    day (total, count and the peak/off-peak split). The filter must select whole days,
+    since each summary replaces the stored one for its device and day.
+    """
+    pipeline = [
+        { "$match": reading_filter },
+        {
+            "$group": {
+                "_id": {
+                    "device_id": "$device_id",
+                    "date": { "$dateTrunc": { "date": "$timestamp", "unit": "day" } }
+                },
+                "total_energy": { "$sum": "$energy_consumption_kwh" },
+                "count": { "$sum": 1 },
+                "on_peak_energy": { "$sum": { "$cond": ["$peak_hours", "$energy_consumption_kwh", 0] } },
+                "on_peak_count": { "$sum": { "$cond": ["$peak_hours", 1, 0] } }
+            }
+        },
+        {
+            "$project": {
+                "device_id": "$_id.device_id",
+                "date": "$_id.date",
+                "total_energy": 1,
+                "count": 1,
+                "on_peak_energy": 1,
+                "on_peak_count": 1,
+                "off_peak_energy": { "$subtract": ["$total_energy", "$on_peak_energy"] },
+                "off_peak_count": { "$subtract": ["$count", "$on_peak_count"] },
+                # Lets delta sync clients notice re-summarized days
+                "updated_at": "$$NOW"
+            }
+        },
+        {
+            "$merge": {
+                "into": DAILY_COLLECTION,
+                "on": "_id",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }
+        }
+    ]
+
+    db["energy_usage"].aggregate(pipeline, allowDiskUse=True)
+
+def find_late_days(db, inserted_since, before):
+    """
+    Days before the given day that received readings inserted after inserted_since,
+    found by the ObjectId time of each reading.
+    """
+    pipeline = [
+        {
+            "$match": {
+                "_id": { "$gte": ObjectId.from_datetime(inserted_since) },
+                "timestamp": { "$lt": before }
+            }
+        },
+        { "$group": { "_id": { "$dateTrunc": { "date": "$timestamp", "unit": "day" } } } }
+    ]
+    return sorted(item["_id"] for item in db["energy_usage"].aggregate(pipeline))
+
+def compact_daily(db, grace_hours, retention_days, now=None):
+    """
+    Compact every day that ended at least grace_hours ago, and re-compact already
+    compacted days that received late readings since the previous run. Days are
+    always recomputed whole, so re-running is safe. Late days whose raw readings
+    start expiring within a compaction interval are left alone, since summarizing
+    them again would replace the stored summary with a partial one.
+    """
+    now = now or datetime.utcnow()
+    expiring_before = now - timedelta(days=retention_days) + timedelta(seconds=COMPACTION_INTERVAL_SECONDS)
+    until = start_of_day(now - timedelta(hours=grace_hours))
+    state = db[STATE_COLLECTION].find_one({ "_id": DAILY_COLLECTION }) or {}
+    compacted_until = state.get("compacted_until")
+    scanned_at = state.get("scanned_at")
+
+    # Late readings for days that are already read from the daily tier
+    if compacted_until is not None and scanned_at is not None:
+        scan_from = scanned_at - timedelta(seconds=LATE_SCAN_OVERLAP_SECONDS)
+        late_days = find_late_days(db, scan_from, compacted_until)
+        expiring = [day for day in late_days if day < expiring_before]
+        if expiring:
+            print(f"Not re-compacting {len(expiring)} days whose raw readings are expiring, first {expiring[0].date()}")
+            late_days = [day for day in late_days if day >= expiring_before]
+        if late_days:
+            summarize_days(db, {
+                "$or": [
+                    { "timestamp": { "$gte": day, "$lt": day + timedelta(days=1) } }
+                    for day in late_days
+                ]
+            })
+
+    if compacted_until is None or compacted_until < until:
+        timestamp_filter = { "$lt": until }
+        if compacted_until is not None:
+            timestamp_filter["$gte"] = compacted_until
+        summarize_days(db, { "timestamp": timestamp_filter })
+        compacted_until = until
+
+    db[STATE_COLLECTION].update_one(
+        { "_id": DAILY_COLLECTION },
+        { "$set": { "compacted_until": compacted_until, "scanned_at": now } },
+        upsert=True
+    )
+    return compacted_until
+
+def ensure_raw_ttl_index(db, retention_days):
+    """
+    Expire raw readings after retention_days. Must only be called once compaction
+    has caught up, otherwise readings could expire before they are summarized.
+    """
+    expire_after = retention_days * 86400
+    try:
+        db["energy_usage"].create_index(
+            [("timestamp", ASCENDING)],
+            name=TTL_INDEX_NAME,
+            expireAfterSeconds=expire_after
+        )
+    except errors.OperationFailure:
+        # The index exists with a different window, so update it in place
+        db.command("collMod", "energy_usage", index={ "name": TTL_INDEX_NAME, "expireAfterSeconds": expire_after })
+
+def create_retention_indexes(db):
+    db[DAILY_COLLECTION].create_index([("device_id", ASCENDING), ("date", ASCENDING)])
+    db[DAILY_COLLECTION].create_index([("updated_at", ASCENDING)])
+
+async def run_compaction_schedule(db, retention_days, grace_hours, interval=COMPACTION_INTERVAL_SECONDS,
+                                  on_compacted=None):
+    """
+    Background job: compact finished days, then make sure the TTL index is in place.
+    on_compacted(compacted_until) is called after every successful run.
+    """
+    while True:
+        try:
+            compacted_until = await asyncio.to_thread(compact_daily, db, grace_hours, retention_days)
+            await asyncio.to_thread(ensure_raw_ttl_index, db, retention_days)
+            print(f"Compacted energy usage up to {compacted_until.date()}")
+            if on_compacted is not None:
+                on_compacted(compacted_until)
+        except errors.PyMongoError as e:
+            print(f"Energy usage compaction failed: {str(e)}")
+        await asyncio.sleep(interval)
+
+def energy_data_stages(compacted_until, local_field, start=None, end=None, as_field="energy_data"):
+    """
+    Stages that join the readings of the device ids in local_field into as_field and unwind it.
+    Each joined row has timestamp, energy_consumption_kwh, count and peak_hours; count is 1
+    for a raw reading and the number of readings summarized for a daily row, so callers
+    must average with $sum of energy / $sum of count.
+
+    Days before the compaction watermark compacted_until (see get_compacted_until) are read
+    from energy_usage_daily (one document per device per day instead of 24), later days from
+    the raw energy_usage collection. start is inclusive and end exclusive.
+    """
+
+    def range_filter(lower, upper):
+        bounds = {}
+        if lower is not None:
+            bounds["$gte"] = lower
+        if upper is not None:
+            bounds["$lt"] = upper
+        return bounds
+
+    raw_start = start
+    if compacted_until is not None and (raw_start is None or raw_start < compacted_until):
+        raw_start = compacted_until
+    use_raw = end is None or raw_start is None or raw_start < end
+    use_daily = compacted_until is not None and (start is None or start < compacted_until)
+
+    lookups = []
+
+    if use_daily:
+        daily_end = compacted_until if end is None else min(end, compacted_until)
+        lookups.append({
+            "$lookup": {
+                "from": DAILY_COLLECTION,
+                "localField": local_field,
+                "foreignField": "device_id",
+                "pipeline": [
+                    { "$match": { "date": range_filter(start and start_of_day(start), daily_end) } },
+                    {
+                        "$project": {
+                            "_id": 0,
+                            "rows": [
+                                {
+                                    "timestamp": "$date",
+                                    "energy_consumption_kwh": "$on_peak_energy",
+                                    "count": "$on_peak_count",
+                                    "peak_hours": True
+                                },
+                                {
+                                    "timestamp": "$date",
+                                    "energy_consumption_kwh": "$off_peak_energy",
+                                    "count": "$off_peak_count",
+                                    "peak_hours": False
+                                }
+                            ]
+                        }
+                    },
+                    { "$unwind": "$rows" },
+                    { "$replaceRoot": { "newRoot": "$rows" } },
+                    { "$match": { "count": { "$gt": 0 } } }
+                ],
+                "as": "_daily_data"
+            }
+        })
+
+    if use_raw:
+        raw_pipeline = []
+        raw_filter = range_filter(raw_start, end)
+        if raw_filter:
+            raw_pipeline.append({ "$match": { "timestamp": raw_filter } })
+        raw_pipeline.append({
+            "$project": {
+                "_id": 0,
+                "timestamp": 1,
+                "energy_consumption_kwh": 1,
+                "peak_hours": 1,
+                "count": { "$literal": 1 }
+            }
+        })
+        lookups.append({
+            "$lookup": {
+                "from": "energy_usage",
+                "localField": local_field,
+                "foreignField": "device_id",
+                "pipeline": raw_pipeline,
+                "as": "_raw_data"
+            }
+        })
+
+    sources = [lookup["$lookup"]["as"] for lookup in lookups]
+    if not sources:
+        # Empty range: join nothing so the unwind drops every document
+        return [{ "$addFields": { as_field: [] } }, { "$unwind": f"${as_field}" }]
+
+    return lookups + [
+        { "$addFields": { as_field: { "$concatArrays": [f"${source}" for source in sources] } } },
+        { "$project": { source: 0 for source in sources } },
+        { "$unwind": f"${as_field}" }
+    ]
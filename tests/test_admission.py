@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import pytest
+from pymongo import errors
+from admission import AdmissionController, QueryRejected
+
+class BlockingQuery():
+    """
+    Stand-in for a blocking aggregation that runs until release() is called.
+    """
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+        self.event = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.event.wait(5)
+        if self.error:
+            raise self.error
+        return self.result
+
+    def release(self):
+        self.event.set()
+
+async def rejection(coroutine):
+    with pytest.raises(QueryRejected) as exc_info:
+        await coroutine
+    return exc_info.value
+
+def test_endpoint_concurrency_limit():
+    async def scenario():
+        admission = AdmissionController({"zip": 1})
+        query = BlockingQuery(result=[1])
+        running = asyncio.ensure_future(admission.run("zip", "a", 1, query))
+        await asyncio.sleep(0)
+
+        rejected = await rejection(admission.run("zip", "b", 1, query))
+        assert rejected.status_code == 429
+        assert rejected.retry_after >= 1
+
+        # Other endpoints have their own limit
+        other = BlockingQuery(result=[2])
+        other.release()
+        assert await admission.run("top-units", "a", 1, other) == [2]
+
+        query.release()
+        assert await running == [1]
+        assert admission.in_flight == {"zip": 0, "top-units": 0}
+    asyncio.run(scenario())
+
+def test_shared_cost_budget():
+    async def scenario():
+        admission = AdmissionController(cost_budget=100)
+        query = BlockingQuery(result=[])
+        running = asyncio.ensure_future(admission.run("a", 1, 80, query))
+        await asyncio.sleep(0)
+
+        assert (await rejection(admission.run("b", 1, 30, query))).status_code == 429
+        cheap = BlockingQuery(result=[])
+        cheap.release()
+        await admission.run("b", 2, 20, cheap)
+
+        query.release()
+        await running
+        assert admission.cost_in_flight == 0
+    asyncio.run(scenario())
+
+def test_oversized_query_does_not_starve_others():
+    async def scenario():
+        admission = AdmissionController(cost_budget=100)
+        huge = BlockingQuery(result=["huge"])
+        running = asyncio.ensure_future(admission.run("zip", "nyc", 10000000, huge))
+        await asyncio.sleep(0)
+
+        small = BlockingQuery(result=["small"])
+        small.release()
+        assert await admission.run("top-units", "lincoln", 100, small) == ["small"]
+
+        # Only one oversized query runs at a time
+        rejected = await rejection(admission.run("top-units", "nyc", 10000000, huge))
+        assert rejected.status_code == 429
+        assert "Narrow the date range" in rejected.detail
+
+        huge.release()
+        assert await running == ["huge"]
+        assert not admission.oversized_in_flight
+    asyncio.run(scenario())
+
+def test_identical_queries_are_coalesced():
+    async def scenario():
+        admission = AdmissionController({"zip": 1})
+        query = BlockingQuery(result=["shared"])
+        waiters = [asyncio.ensure_future(admission.run("zip", ("nyc", "day"), 50, query)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        query.release()
+        assert await asyncio.gather(*waiters) == [["shared"]] * 5
+        assert query.calls == 1
+        assert admission.pending == {}
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_does_not_cancel_shared_query():
+    async def scenario():
+        admission = AdmissionController()
+        query = BlockingQuery(result=["shared"])
+        first = asyncio.ensure_future(admission.run("zip", "k", 1, query))
+        second = asyncio.ensure_future(admission.run("zip", "k", 1, query))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        query.release()
+        assert await second == ["shared"]
+    asyncio.run(scenario())
+
+def test_time_limit_becomes_503():
+    async def scenario():
+        admission = AdmissionController()
+        query = BlockingQuery(error=errors.ExecutionTimeout("operation exceeded time limit"))
+        query.release()
+        rejected = await rejection(admission.run("zip", "k", 1, query))
+        assert rejected.status_code == 503
+        assert admission.in_flight["zip"] == 0
+    asyncio.run(scenario())
+
+def test_other_errors_propagate():
+    async def scenario():
+        admission = AdmissionController()
+        query = BlockingQuery(error=errors.OperationFailure("bad pipeline"))
+        query.release()
+        with pytest.raises(errors.OperationFailure):
+            await admission.run("zip", "k", 1, query)
+    asyncio.run(scenario())
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+import pytest
+from delta_sync import (InvalidSyncToken, bucket_start, changed_bucket_range, next_bucket,
+                        parse_since, sync_version, SYNC_LAG_SECONDS)
+
+@pytest.mark.parametrize("value, bucket, start, end", [
+    (datetime(2024, 12, 18, 5), "day", datetime(2024, 12, 18), datetime(2024, 12, 19)),
+    (datetime(2024, 12, 31, 23, 59), "day", datetime(2024, 12, 31), datetime(2025, 1, 1)),
+    # 2024-12-18 is a Wednesday; weeks start on Sunday like $dateTrunc
+    (datetime(2024, 12, 18, 5), "week", datetime(2024, 12, 15), datetime(2024, 12, 22)),
+    (datetime(2024, 12, 15), "week", datetime(2024, 12, 15), datetime(2024, 12, 22)),
+    (datetime(2024, 12, 14, 23), "week", datetime(2024, 12, 8), datetime(2024, 12, 15)),
+    # A week spanning the new year
+    (datetime(2025, 1, 2), "week", datetime(2024, 12, 29), datetime(2025, 1, 5)),
+    (datetime(2024, 11, 30, 12), "month", datetime(2024, 11, 1), datetime(2024, 12, 1)),
+    (datetime(2024, 12, 31, 12), "month", datetime(2024, 12, 1), datetime(2025, 1, 1)),
+    (datetime(2024, 2, 29), "month", datetime(2024, 2, 1), datetime(2024, 3, 1)),
+])
+def test_bucket_boundaries(value, bucket, start, end):
+    assert bucket_start(value, bucket) == start
+    assert next_bucket(value, bucket) == end
+
+def test_sync_version_round_trip():
+    since = parse_since(sync_version())
+    lag = datetime.now(timezone.utc) - since
+    assert SYNC_LAG_SECONDS - 2 <= lag.total_seconds() <= SYNC_LAG_SECONDS + 2
+
+def test_parse_since():
+    assert parse_since(None) is None
+    assert parse_since("1730000000") == datetime(2024, 10, 27, 3, 33, 20, tzinfo=timezone.utc)
+    with pytest.raises(InvalidSyncToken):
+        parse_since("yesterday")
+
+class FakeCollection():
+    def __init__(self, result):
+        self.result = result
+        self.calls = []
+
+    def aggregate(self, pipeline, **kwargs):
+        self.calls.append((pipeline, kwargs))
+        return self.result
+
+def test_changed_bucket_range_combines_raw_and_daily_changes():
+    db = {
+        "energy_usage": FakeCollection([{"first": datetime(2024, 10, 30, 3), "last": datetime(2024, 10, 31, 5)}]),
+        "energy_usage_daily": FakeCollection([{"first": datetime(2024, 10, 27), "last": datetime(2024, 10, 27)}])
+    }
+    since = datetime(2024, 10, 31, tzinfo=timezone.utc)
+
+    assert changed_bucket_range(db, since, ["d1", "d2"], "day", 5000) == (datetime(2024, 10, 27), datetime(2024, 11, 1))
+
+    for collection in db.values():
+        pipeline, options = collection.calls[0]
+        assert pipeline[0]["$match"]["device_id"] == {"$in": ["d1", "d2"]}
+        assert options == {"maxTimeMS": 5000}
+
+def test_changed_bucket_range_nothing_changed():
+    db = {"energy_usage": FakeCollection([]), "energy_usage_daily": FakeCollection([])}
+    assert changed_bucket_range(db, datetime(2024, 10, 31, tzinfo=timezone.utc), ["d1"]) is None
+
+def test_changed_bucket_range_without_device_filter():
+    db = {
+        "energy_usage": FakeCollection([]),
+        "energy_usage_daily": FakeCollection([{"first": datetime(2024, 10, 2), "last": datetime(2024, 10, 3)}])
+    }
+    since = datetime(2024, 10, 31)
+
+    assert changed_bucket_range(db, since) == (datetime(2024, 10, 2), datetime(2024, 10, 4))
+    for collection in db.values():
+        pipeline, _ = collection.calls[0]
+        assert "device_id" not in pipeline[0]["$match"]
+    assert db["energy_usage_daily"].calls[0][0][0]["$match"] == {"updated_at": {"$gte": since}}
@@ -0,0 +1,30 @@
+import random
+from geo_utils import GRID_PRECISION, decode_geohash, encode_geohash
+
+def test_encode_known_geohash():
+    assert encode_geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert encode_geohash(40.7128, -74.0060) == "dr5reg"
+
+def test_default_precision():
+    assert len(encode_geohash(40.8, -96.7)) == GRID_PRECISION
+
+def test_decode_bounds_contain_point():
+    random.seed(512)
+    for _ in range(200):
+        lat, lon = random.uniform(-90, 90), random.uniform(-180, 180)
+        for precision in (1, 4, GRID_PRECISION, 9):
+            bounds = decode_geohash(encode_geohash(lat, lon, precision))
+            assert bounds["min_lat"] <= lat <= bounds["max_lat"]
+            assert bounds["min_lon"] <= lon <= bounds["max_lon"]
+
+def test_round_trip_through_cell_center():
+    geohash = encode_geohash(32.7157, -117.1611)
+    center = decode_geohash(geohash)
+    assert encode_geohash(center["lat"], center["lon"]) == geohash
+
+def test_prefix_is_parent_cell():
+    geohash = encode_geohash(40.7128, -74.0060, 8)
+    parent = decode_geohash(geohash[:4])
+    child = decode_geohash(geohash)
+    assert parent["min_lat"] <= child["min_lat"] <= child["max_lat"] <= parent["max_lat"]
+    assert parent["min_lon"] <= child["min_lon"] <= child["max_lon"] <= parent["max_lon"]
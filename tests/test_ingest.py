@@ -0,0 +1,157 @@
+import asyncio
+from datetime import datetime
+import pytest
+from pymongo import errors
+from ingest import IngestBuffer, InvalidReading, normalize_reading
+
+class FakeCollection():
+    def __init__(self, failures=()):
+        self.batches = []
+        # Exceptions raised by the next insert_many calls, in order
+        self.failures = list(failures)
+
+    def insert_many(self, documents, ordered=True):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.batches.append(list(documents))
+
+    @property
+    def count(self):
+        return sum(len(batch) for batch in self.batches)
+
+def reading(hour=18, day=1):
+    return normalize_reading({
+        "device_id": "device-1",
+        "timestamp": datetime(2024, 10, day, hour).isoformat(),
+        "energy_consumption_kwh": 2.5
+    })
+
+def test_normalize_reading_fields():
+    doc = normalize_reading({"device_id": "d", "timestamp": "2024-10-01T18:30:00Z", "energy_consumption_kwh": 3})
+    assert doc["timestamp"] == datetime(2024, 10, 1, 18, 30)
+    assert doc["energy_consumption_kwh"] == 3.0
+    assert doc["peak_hours"] is True
+
+def test_normalize_reading_converts_to_naive_utc():
+    doc = normalize_reading({"device_id": "d", "timestamp": "2024-10-01T12:00:00-05:00", "energy_consumption_kwh": 1})
+    assert doc["timestamp"] == datetime(2024, 10, 1, 17, 0)
+
+def test_normalize_reading_epoch_timestamp():
+    doc = normalize_reading({"device_id": "d", "timestamp": 1727802000, "energy_consumption_kwh": 1})
+    assert doc["timestamp"] == datetime(2024, 10, 1, 17, 0)
+
+def test_normalize_reading_peak_hours():
+    # 2024-10-05 is a Saturday, so evenings are off-peak
+    assert reading(hour=18, day=5)["peak_hours"] is False
+    assert reading(hour=10, day=1)["peak_hours"] is False
+    explicit = normalize_reading({"device_id": "d", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": 1, "peak_hours": True})
+    assert explicit["peak_hours"] is True
+
+def test_normalize_reading_rejects_readings_before_oldest():
+    raw = {"device_id": "d", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": 1}
+    assert normalize_reading(raw, oldest=datetime(2024, 10, 1))["device_id"] == "d"
+    with pytest.raises(InvalidReading):
+        normalize_reading(raw, oldest=datetime(2024, 10, 2))
+
+@pytest.mark.parametrize("raw", [
+    [],
+    {"timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": 1},
+    {"device_id": "", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": 1},
+    {"device_id": "d", "energy_consumption_kwh": 1},
+    {"device_id": "d", "timestamp": "yesterday", "energy_consumption_kwh": 1},
+    {"device_id": "d", "timestamp": True, "energy_consumption_kwh": 1},
+    {"device_id": "d", "timestamp": "2024-10-01T10:00:00"},
+    {"device_id": "d", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": -1},
+    {"device_id": "d", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": float("nan")},
+    {"device_id": "d", "timestamp": "2024-10-01T10:00:00", "energy_consumption_kwh": "1"},
+])
+def test_normalize_reading_rejects_invalid(raw):
+    with pytest.raises(InvalidReading):
+        normalize_reading(raw)
+
+def test_offer_is_all_or_nothing():
+    async def scenario():
+        buffer = IngestBuffer(FakeCollection(), max_size=5)
+        assert buffer.offer([reading()] * 3)
+        assert not buffer.offer([reading()] * 3)
+        assert buffer.queue.qsize() == 3
+        assert buffer.retry_after() >= 1
+    asyncio.run(scenario())
+
+def test_batches_by_size():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = IngestBuffer(collection, batch_size=4, max_latency_ms=1000)
+        buffer.start()
+        buffer.offer([reading()] * 10)
+        await asyncio.sleep(0.05)
+        # Two full batches go out without waiting for the latency threshold
+        assert [len(batch) for batch in collection.batches] == [4, 4]
+        await buffer.stop()
+        assert [len(batch) for batch in collection.batches] == [4, 4, 2]
+    asyncio.run(scenario())
+
+def test_flushes_partial_batch_after_latency():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = IngestBuffer(collection, batch_size=100, max_latency_ms=20)
+        buffer.start()
+        buffer.offer([reading()] * 3)
+        await asyncio.sleep(0.1)
+        assert collection.count == 3
+        await buffer.stop()
+    asyncio.run(scenario())
+
+def test_stop_flushes_batch_being_collected():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = IngestBuffer(collection, batch_size=100, max_latency_ms=10000)
+        buffer.start()
+        buffer.offer([reading()] * 10)
+        # Let the writer move the readings into its batch and wait for more
+        await asyncio.sleep(0.01)
+        assert buffer.queue.empty()
+        await buffer.stop()
+        assert collection.count == 10
+        assert buffer.written == 10
+    asyncio.run(scenario())
+
+def test_stop_flushes_readings_offered_before_start():
+    async def scenario():
+        collection = FakeCollection()
+        buffer = IngestBuffer(collection)
+        buffer.offer([reading()] * 3)
+        await buffer.stop()
+        assert collection.count == 3
+    asyncio.run(scenario())
+
+def test_ids_are_assigned_at_write_time():
+    collection = FakeCollection(failures=[errors.AutoReconnect("down")])
+    buffer = IngestBuffer(collection, retry_delay=0)
+    batch = [reading(), reading()]
+    assert all("_id" not in doc for doc in batch)
+    buffer.write_batch(batch)
+    ids = [doc["_id"] for doc in collection.batches[0]]
+    assert len(set(ids)) == 2
+    # The retry reused the ids of the failed attempt
+    assert ids == [doc["_id"] for doc in batch]
+
+def test_retries_transient_errors():
+    collection = FakeCollection(failures=[errors.AutoReconnect("primary stepped down")])
+    buffer = IngestBuffer(collection, retry_delay=0)
+    buffer.write_batch([reading()] * 5)
+    assert collection.count == 5
+    assert (buffer.written, buffer.failed) == (5, 0)
+
+def test_gives_up_after_retries():
+    collection = FakeCollection(failures=[errors.AutoReconnect("down")] * 3)
+    buffer = IngestBuffer(collection, write_retries=2, retry_delay=0)
+    buffer.write_batch([reading()] * 5)
+    assert (buffer.written, buffer.failed) == (0, 5)
+
+def test_duplicates_from_earlier_attempt_count_as_written():
+    details = {"nInserted": 3, "writeErrors": [{"code": 11000}, {"code": 11000}, {"code": 121}]}
+    collection = FakeCollection(failures=[errors.BulkWriteError(details)])
+    buffer = IngestBuffer(collection)
+    buffer.write_batch([reading()] * 6)
+    assert (buffer.written, buffer.failed) == (5, 1)
@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+from retention import DAILY_COLLECTION, compact_daily, energy_data_stages, oldest_accepted_day
+
+class FakeCollection():
+    def __init__(self, late_days=()):
+        self.pipelines = []
+        self.late_days = list(late_days)
+        self.state = None
+
+    def aggregate(self, pipeline, **kwargs):
+        self.pipelines.append(pipeline)
+        if "_id" in pipeline[0]["$match"]:
+            return [{"_id": day} for day in self.late_days]
+        return []
+
+    def find_one(self, query):
+        return self.state
+
+    def update_one(self, query, update, upsert=False):
+        self.state = dict(update["$set"], _id=query["_id"])
+
+class FakeDB(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+def summarized_filters(db):
+    return [p[0]["$match"] for p in db["energy_usage"].pipelines if p[-1].get("$merge")]
+
+def test_first_run_compacts_days_before_grace_period():
+    db = FakeDB()
+    compacted_until = compact_daily(db, grace_hours=6, retention_days=30, now=datetime(2024, 11, 5, 3))
+    # 03:00 minus 6 hours is still Nov 4, so Nov 4 stays raw
+    assert compacted_until == datetime(2024, 11, 4)
+    assert summarized_filters(db) == [{"timestamp": {"$lt": datetime(2024, 11, 4)}}]
+    assert db["retention_state"].state["scanned_at"] == datetime(2024, 11, 5, 3)
+
+def test_recompacts_days_with_late_readings():
+    db = FakeDB()
+    db["energy_usage"].late_days = [datetime(2024, 11, 1), datetime(2024, 11, 3)]
+    db["retention_state"].state = {
+        "_id": DAILY_COLLECTION,
+        "compacted_until": datetime(2024, 11, 4),
+        "scanned_at": datetime(2024, 11, 4, 23)
+    }
+
+    compacted_until = compact_daily(db, grace_hours=6, retention_days=30, now=datetime(2024, 11, 6, 1))
+
+    assert compacted_until == datetime(2024, 11, 5)
+    late, new = summarized_filters(db)
+    assert late == {"$or": [
+        {"timestamp": {"$gte": datetime(2024, 11, 1), "$lt": datetime(2024, 11, 2)}},
+        {"timestamp": {"$gte": datetime(2024, 11, 3), "$lt": datetime(2024, 11, 4)}}
+    ]}
+    assert new == {"timestamp": {"$gte": datetime(2024, 11, 4), "$lt": datetime(2024, 11, 5)}}
+
+def test_nothing_new_only_moves_scan_time():
+    db = FakeDB()
+    db["retention_state"].state = {
+        "_id": DAILY_COLLECTION,
+        "compacted_until": datetime(2024, 11, 5),
+        "scanned_at": datetime(2024, 11, 6, 0)
+    }
+    assert compact_daily(db, grace_hours=6, retention_days=30, now=datetime(2024, 11, 6, 1)) == datetime(2024, 11, 5)
+    assert summarized_filters(db) == []
+    assert db["retention_state"].state["scanned_at"] == datetime(2024, 11, 6, 1)
+
+def test_skips_late_days_whose_readings_are_expiring():
+    db = FakeDB()
+    db["energy_usage"].late_days = [datetime(2024, 10, 7), datetime(2024, 10, 8), datetime(2024, 11, 3)]
+    db["retention_state"].state = {
+        "_id": DAILY_COLLECTION,
+        "compacted_until": datetime(2024, 11, 5),
+        "scanned_at": datetime(2024, 11, 6, 22)
+    }
+
+    # Readings of Oct 7 started expiring at Nov 6 00:00, those of Oct 8 expire within the hour
+    compact_daily(db, grace_hours=6, retention_days=30, now=datetime(2024, 11, 6, 23, 40))
+
+    late = summarized_filters(db)[0]
+    assert late == {"$or": [
+        {"timestamp": {"$gte": datetime(2024, 11, 3), "$lt": datetime(2024, 11, 4)}}
+    ]}
+
+def test_oldest_accepted_day_keeps_a_full_day_past_the_next_run():
+    now = datetime(2024, 11, 6, 23, 40)
+    oldest = oldest_accepted_day(now, retention_days=30)
+    # The next run can be at 00:40, which already counts as Nov 7
+    assert oldest == datetime(2024, 10, 10)
+    # The first readings of the oldest day are kept a full day past the next compaction run
+    assert oldest + timedelta(days=30) >= now + timedelta(hours=1, days=1)
+    # A reading late on an older day is rejected even though its own timestamp is recent enough
+    assert datetime(2024, 10, 8, 23, 50) < oldest
+
+def test_oldest_accepted_day_early_in_the_day():
+    assert oldest_accepted_day(datetime(2024, 11, 6, 0, 5), retention_days=30) == datetime(2024, 10, 9)
+
+def lookups(stages):
+    return {stage["$lookup"]["from"]: stage["$lookup"]["pipeline"] for stage in stages if "$lookup" in stage}
+
+def test_energy_data_stages_before_first_compaction_reads_raw_only():
+    stages = energy_data_stages(None, "devices.device_id", datetime(2024, 10, 1), datetime(2024, 10, 8))
+    assert list(lookups(stages)) == ["energy_usage"]
+    assert lookups(stages)["energy_usage"][0] == {
+        "$match": {"timestamp": {"$gte": datetime(2024, 10, 1), "$lt": datetime(2024, 10, 8)}}
+    }
+
+def test_energy_data_stages_splits_at_the_watermark():
+    stages = energy_data_stages(datetime(2024, 10, 5), "devices.device_id", datetime(2024, 10, 1), datetime(2024, 10, 8))
+    joined = lookups(stages)
+    assert joined[DAILY_COLLECTION][0] == {"$match": {"date": {"$gte": datetime(2024, 10, 1), "$lt": datetime(2024, 10, 5)}}}
+    assert joined["energy_usage"][0] == {"$match": {"timestamp": {"$gte": datetime(2024, 10, 5), "$lt": datetime(2024, 10, 8)}}}
+
+def test_energy_data_stages_range_before_the_watermark_reads_daily_only():
+    stages = energy_data_stages(datetime(2024, 10, 5), "device_id", datetime(2024, 10, 1), datetime(2024, 10, 3))
+    assert list(lookups(stages)) == [DAILY_COLLECTION]